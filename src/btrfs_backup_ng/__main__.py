@@ -30,8 +30,6 @@ SOFTWARE.
 
 import concurrent.futures
 import logging
-import logging.handlers
-import multiprocessing
 import os
 import sys
 import threading
@@ -39,13 +37,6 @@ import time
 
 from math import inf
 
-from rich.align import Align
-from rich.layout import Layout
-from rich.live import Live
-from rich.panel import Panel
-from rich.progress import BarColumn, Progress, SpinnerColumn, TimeElapsedColumn
-from rich.text import Text
-
 from . import endpoint
 from . import util
 from .rich_logger import RichLogger, create_logger, cons, logger
@@ -69,13 +60,15 @@ def send_snapshot(snapshot, destination_endpoint, parent=None, clones=None):
     pipes = [snapshot.endpoint.send(snapshot, parent=parent, clones=clones)]
 
     pipes.append(destination_endpoint.receive(pipes[-1].stdout))
-
-    pids = [pipe.pid for pipe in pipes]
-    while pids:
-        pid, return_code = os.wait()
-        if pid in pids:
-            logger.debug("  -> PID %d exited with return code %d", pid, return_code)
-            pids.remove(pid)
+    # receive holds its own copy now; without closing ours, btrfs send would
+    # block forever on a full pipe instead of getting SIGPIPE if receive dies
+    pipes[0].stdout.close()
+
+    # wait only for our own pipes, other tasks may be running in
+    # sibling threads with children of their own
+    for pipe in pipes:
+        return_code = pipe.wait()
+        logger.debug("  -> PID %d exited with return code %d", pipe.pid, return_code)
         if return_code != 0:
             logger.error("Error during btrfs send / receive")
             raise util.SnapshotTransferError()
@@ -104,13 +97,16 @@ def sync_snapshots(
 
     # delete corrupt snapshots from destination
     to_remove = []
+    destination_snapshots_by_name = {
+        snapshot.get_name(): snapshot for snapshot in destination_snapshots
+    }
     for snapshot in source_snapshots:
-        if snapshot in destination_snapshots and destination_id in snapshot.locks:
+        if destination_id not in snapshot.locks:
+            continue
+        destination_snapshot = destination_snapshots_by_name.get(snapshot.get_name())
+        if destination_snapshot is not None:
             # seems to have failed previously and is present at
             # destination; delete corrupt snapshot there
-            destination_snapshot = destination_snapshots[
-                destination_snapshots.index(snapshot)
-            ]
             logger.info(
                 "Potentially corrupt snapshot %s found at %s",
                 destination_snapshot,
@@ -123,34 +119,46 @@ def sync_snapshots(
         # disappear
         destination_snapshots = destination_endpoint.list_snapshots()
     # now that deletion worked, remove all locks for this destination
-    for snapshot in source_snapshots:
-        if destination_id in snapshot.locks:
-            source_endpoint.set_lock(snapshot, destination_id, False)
-        if destination_id in snapshot.parent_locks:
-            source_endpoint.set_lock(snapshot, destination_id, False, parent=True)
+    source_endpoint.remove_locks(destination_id)
 
     logger.debug("Planning transmissions ...")
+    # snapshots are compared by name through sets and dicts below, as
+    # scanning the snapshot lists with ``in`` and ``index()`` for every
+    # candidate makes planning quadratic
+    source_indices = {
+        snapshot.get_name(): i for i, snapshot in enumerate(source_snapshots)
+    }
+    destination_names = {snapshot.get_name() for snapshot in destination_snapshots}
     to_consider = source_snapshots
     if keep_num_backups > 0:
         # it wouldn't make sense to transfer snapshots that would be deleted
         # afterward anyway
         to_consider = to_consider[-keep_num_backups:]
     to_transfer = [
-        snapshot for snapshot in to_consider if snapshot not in destination_snapshots
+        snapshot
+        for snapshot in to_consider
+        if snapshot.get_name() not in destination_names
     ]
 
     if not to_transfer:
         logger.info("No snapshots need to be transferred.")
         return
 
-    logger.info("Going to transfer %d snapshot(s):", len(to_transfer))
-    for _ in to_transfer:
-        logger.info("  %s", snapshot)
+    logger.info(
+        "Going to transfer %d snapshot(s):\n%s",
+        len(to_transfer),
+        "\n".join(f"  {snapshot}" for snapshot in to_transfer),
+    )
+
+    # parents found for the candidates, they stay valid until the set of
+    # snapshots present at the destination changes
+    parents = {}
 
     while to_transfer:
         if no_incremental:
             # simply choose the last one
-            best_snapshot = to_transfer[-1]
+            best_index = len(to_transfer) - 1
+            best_snapshot = to_transfer[best_index]
             parent = None
             clones = []
         else:
@@ -159,20 +167,27 @@ def sync_snapshots(
             present_snapshots = [
                 snapshot
                 for snapshot in source_snapshots
-                if snapshot in destination_snapshots
+                if snapshot.get_name() in destination_names
                 and destination_id not in snapshot.locks
             ]
 
+            def find_parent(s):
+                name = s.get_name()
+                if name not in parents:
+                    parents[name] = s.find_parent(present_snapshots)
+                return parents[name]
+
             # choose snapshot with the smallest distance to its parent
             def key(s):
-                p = s.find_parent(present_snapshots)
+                p = find_parent(s)
                 if p is None:
                     return inf
-                d = source_snapshots.index(s) - source_snapshots.index(p)
+                d = source_indices[s.get_name()] - source_indices[p.get_name()]
                 return -d if d < 0 else d
 
-            best_snapshot = min(to_transfer, key=key)
-            parent = best_snapshot.find_parent(present_snapshots)
+            best_index = min(range(len(to_transfer)), key=lambda i: key(to_transfer[i]))
+            best_snapshot = to_transfer[best_index]
+            parent = find_parent(best_snapshot)
             # we don't use clones at the moment, because they don't seem
             # to speed things up
             # clones = present_snapshots
@@ -197,16 +212,21 @@ def sync_snapshots(
             source_endpoint.set_lock(best_snapshot, destination_id, False)
             if parent:
                 source_endpoint.set_lock(parent, destination_id, False, parent=True)
+            # the endpoint's snapshot cache is updated by add_snapshot(),
+            # so there's no need to list the destination again
             destination_endpoint.add_snapshot(best_snapshot)
-            destination_snapshots = destination_endpoint.list_snapshots()
-        to_transfer.remove(best_snapshot)
+            destination_names.add(best_snapshot.get_name())
+            parents.clear()
+        # remove by position, remove() would compare against every
+        # snapshot up to the chosen one
+        del to_transfer[best_index]
 
     logger.info(util.log_heading(f"Transfers to {destination_endpoint} complete!"))
 
 
-def parse_options(global_parser, argv):
-    """Run the program. Items in ``argv`` are treated as command line
-    arguments."""
+def create_parser(global_parser):
+    """Build the argument parser for a single task. It is built once
+    and reused for parsing the arguments of every task."""
 
     description = """\
 This provides incremental backups for btrfs filesystems. It can be
@@ -298,6 +318,14 @@ files is allowed as well."""
         help="Don't ever try to send snapshots incrementally."
         " This might be useful when piping to a file for storage.",
     )
+    group.add_argument(
+        "--pipe-size",
+        type=util.pipe_size,
+        default=endpoint.common.PIPE_SIZE,
+        help="Size in bytes of the pipe buffer between btrfs send and receive."
+        " Larger buffers let both run more smoothly. Use 0 to keep the"
+        f" system default. Default is {endpoint.common.PIPE_SIZE}.",
+    )
 
     group = parser.add_argument_group("SSH related options")
     group.add_argument(
@@ -386,6 +414,13 @@ files is allowed as well."""
         "for well-organized local snapshotting without backing up.",
     )
 
+    return parser
+
+
+def parse_options(parser, argv):
+    """Parse the arguments of a single task. Items in ``argv`` are
+    treated as command line arguments."""
+
     # parse args then convert to dict format
     options = {}
     try:
@@ -405,11 +440,9 @@ files is allowed as well."""
     return options
 
 
-def run_task(options, queue):
+def run_task(options):
     """Create a list of tasks to run."""
 
-    logger.setLevel(options["verbosity"].upper())
-
     # applying shortcuts
     if "quiet" in options:
         options["verbosity"] = "warning"
@@ -418,7 +451,6 @@ def run_task(options, queue):
 
     logger.info(util.log_heading(f"Started at {time.ctime()}"))
 
-    logger.debug(util.log_heading("Settings"))
     if "snapshot_folder" in options:
         snapshot_directory = options["snapshot_folder"]
     else:
@@ -427,29 +459,35 @@ def run_task(options, queue):
     if "snapshot_prefix" in options:
         snapshot_prefix = options["snapshot_prefix"]
     else:
-        snapshot_prefix = f"{os.uname()[1]}-"
-
-    logger.debug("Enable btrfs debugging: %r", options["btrfs_debug"])
-    logger.debug("Don't take a new snapshot: %r", options["no_snapshot"])
-    logger.debug("Number of snapshots to keep: %d", options["num_snapshots"])
-    logger.debug(
-        "Number of backups to keep: %s",
-        (str(options["num_backups"]) if options["num_backups"] > 0 else "Any"),
-    )
-    logger.debug("Snapshot folder: %s", snapshot_directory)
-    logger.debug("Snapshot prefix: %s", snapshot_prefix if snapshot_prefix else None)
-    logger.debug("Don't transfer snapshots: %r", options["no_transfer"])
-    logger.debug("Don't send incrementally: %r", options["no_incremental"])
-    logger.debug("Extra SSH config options: %s", options["ssh_opt"])
-    logger.debug("Use sudo at SSH remote host: %r", options["ssh_sudo"])
-    logger.debug("Run 'btrfs subvolume sync' afterwards: %r", options["sync"])
-    logger.debug(
-        "Convert subvolumes to read-write before deletion: %r",
-        options["convert_rw"],
-    )
-    logger.debug("Remove locks for given destinations: %r", options["remove_locks"])
-    logger.debug("Skip filesystem checks: %r", options["skip_fs_checks"])
-    logger.debug("Auto add locked destinations: %r", options["locked_destinations"])
+        snapshot_prefix = f"{util.get_hostname()}-"
+
+    # skip formatting the settings entirely unless they are going to be shown
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(util.log_heading("Settings"))
+        logger.debug("Enable btrfs debugging: %r", options["btrfs_debug"])
+        logger.debug("Don't take a new snapshot: %r", options["no_snapshot"])
+        logger.debug("Number of snapshots to keep: %d", options["num_snapshots"])
+        logger.debug(
+            "Number of backups to keep: %s",
+            (str(options["num_backups"]) if options["num_backups"] > 0 else "Any"),
+        )
+        logger.debug("Snapshot folder: %s", snapshot_directory)
+        logger.debug(
+            "Snapshot prefix: %s", snapshot_prefix if snapshot_prefix else None
+        )
+        logger.debug("Don't transfer snapshots: %r", options["no_transfer"])
+        logger.debug("Don't send incrementally: %r", options["no_incremental"])
+        logger.debug("Pipe size: %d", options["pipe_size"])
+        logger.debug("Extra SSH config options: %s", options["ssh_opt"])
+        logger.debug("Use sudo at SSH remote host: %r", options["ssh_sudo"])
+        logger.debug("Run 'btrfs subvolume sync' afterwards: %r", options["sync"])
+        logger.debug(
+            "Convert subvolumes to read-write before deletion: %r",
+            options["convert_rw"],
+        )
+        logger.debug("Remove locks for given destinations: %r", options["remove_locks"])
+        logger.debug("Skip filesystem checks: %r", options["skip_fs_checks"])
+        logger.debug("Auto add locked destinations: %r", options["locked_destinations"])
 
     # kwargs that are common between all endpoints
     endpoint_kwargs = {
@@ -458,13 +496,13 @@ def run_task(options, queue):
         "subvolume_sync": options["sync"],
         "btrfs_debug": options["btrfs_debug"],
         "fs_checks": not options["skip_fs_checks"],
+        "pipe_size": options["pipe_size"],
         "ssh_opts": options["ssh_opt"],
         "ssh_sudo": options["ssh_sudo"],
     }
 
     logger.debug("Source: %s", options["source"])
-    source_endpoint_kwargs = dict(endpoint_kwargs)
-    source_endpoint_kwargs["path"] = snapshot_directory
+    source_endpoint_kwargs = {**endpoint_kwargs, "path": snapshot_directory}
     try:
         source_endpoint = endpoint.choose_endpoint(
             options["source"], source_endpoint_kwargs, source=True
@@ -494,6 +532,7 @@ def run_task(options, queue):
                     source_endpoint.set_lock(snap, destination, False, parent=True)
 
     destination_endpoints = []
+    destination_ids = set()
     # only create destination endpoints if they are needed
     if options["no_transfer"] and options["num_backups"] <= 0:
         logger.debug(
@@ -510,9 +549,29 @@ def run_task(options, queue):
             except ValueError as e:
                 logger.error("Couldn't parse destination specification: %s", e)
                 raise util.AbortError()
+            # the same destination may be given more than once, e.g. by
+            # --locked-destinations, prepare and sync it only once
+            if destination_endpoint.get_id() in destination_ids:
+                logger.debug("Destination already prepared, skipping it.")
+                continue
+            destination_ids.add(destination_endpoint.get_id())
             destination_endpoints.append(destination_endpoint)
             logger.debug("Destination endpoint: %s", destination_endpoint)
-            destination_endpoint.prepare()
+
+    if destination_endpoints:
+        # preparing may involve connecting to remote hosts, which is slow but
+        # independent for every destination, so do it concurrently
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(destination_endpoints),
+            # keep the task's name in log messages of the helper threads
+            thread_name_prefix=f"{threading.current_thread().name}-Prepare",
+        ) as executor:
+            futures = [
+                executor.submit(destination_endpoint.prepare)
+                for destination_endpoint in destination_endpoints
+            ]
+            for future in futures:
+                future.result()
 
     if options["no_snapshot"]:
         logger.info("Taking no snapshot (--no-snapshot).")
@@ -554,16 +613,27 @@ def run_task(options, queue):
                 e,
             )
     # cleanup backups > num_backups in backup target
-    if options["num_backups"] > 0:
-        for destination_endpoint in destination_endpoints:
-            try:
-                destination_endpoint.delete_old_snapshots(options["num_backups"])
-            except util.AbortError as e:
-                logger.debug(
-                    "Got AbortError while deleting backups at %s\n" "Caught: %s",
-                    destination_endpoint,
-                    e,
-                )
+    if options["num_backups"] > 0 and destination_endpoints:
+        # destinations don't depend on each other, so clean them up concurrently
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(destination_endpoints),
+            thread_name_prefix=f"{threading.current_thread().name}-Cleanup",
+        ) as executor:
+            futures = {
+                executor.submit(
+                    destination_endpoint.delete_old_snapshots, options["num_backups"]
+                ): destination_endpoint
+                for destination_endpoint in destination_endpoints
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except util.AbortError as e:
+                    logger.debug(
+                        "Got AbortError while deleting backups at %s\n" "Caught: %s",
+                        futures[future],
+                        e,
+                    )
 
     logger.info(util.log_heading(f"Finished at {time.ctime()}"))
 
@@ -580,14 +650,129 @@ def elevate_privileges():
         os.execvp("sudo", command)
 
 
-def serve_logger_thread(queue):
-    """Run the logger from a thread in main to talk to all children."""
-    while True:
-        record = queue.get()
-        if record is None:
-            break
-        logger = logging.getLogger(record.name)
-        logger.handle(record)
+def get_max_workers(total_tasks):
+    """Number of worker threads to run ``total_tasks`` tasks with. Tasks
+    mostly wait on btrfs send / receive, so more workers than CPUs is
+    fine, but there is no use for more workers than tasks."""
+    return max(1, min(total_tasks, (os.cpu_count() or 4) * 2))
+
+
+def do_logging(task_options):
+    """Run all tasks, logging straight to the console."""
+    # tasks mostly wait on btrfs send / receive subprocesses, so threads
+    # are sufficient and avoid pickling options and log records
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_max_workers(len(task_options)), thread_name_prefix="Task"
+    ) as executor:
+        for options in task_options:
+            executor.submit(run_task, options)
+
+
+def do_live_layout(task_options):
+    """Run all tasks, displaying their progress and logs in a Live layout."""
+    # rich's layout and progress machinery is only needed here, so don't
+    # pay for importing it on every start
+    from rich.align import Align
+    from rich.layout import Layout
+    from rich.live import Live
+    from rich.panel import Panel
+    from rich.progress import BarColumn, Progress, SpinnerColumn, TimeElapsedColumn
+    from rich.text import Text
+
+    total_tasks = len(task_options)
+
+    layout = Layout(name="root")
+
+    layout.split(
+        Layout(name="header", size=5),
+        Layout(name="main"),
+        Layout(name="footer", size=3),
+    )
+
+    layout["main"].split_row(
+        Layout(name="tasks"), Layout(name="logs", ratio=2, minimum_size=80)
+    )
+
+    layout["header"].update(
+        Panel(
+            Align.center(
+                Text(
+                    """btrfs-backup-ng\n\nIncremental backups for the btrfs filesystem.""",
+                    justify="center",
+                ),
+                vertical="middle",
+            )
+        ),
+    )
+
+    overall_progress = Progress(
+        "[progress.description]{task.description}",
+        BarColumn(),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        SpinnerColumn(),
+        TimeElapsedColumn(),
+    )
+
+    tasks_progress = Progress(
+        "{task.description}",
+        BarColumn(),
+        SpinnerColumn(),
+        TimeElapsedColumn(),
+    )
+
+    overall_task_id = overall_progress.add_task(
+        "[green]All jobs progress:",
+        total=total_tasks,
+    )
+
+    log = RichLogger()
+    # the logs panel is created once, only its text is replaced later on
+    log_text = Text(log.joined)
+
+    layout["tasks"].update(Panel(tasks_progress))
+    layout["logs"].update(Panel(log_text))
+    layout["footer"].update(Panel(overall_progress))
+
+    pending = {}  # unfinished futures mapped to their progress task_id
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=get_max_workers(total_tasks), thread_name_prefix="Task"
+    ) as executor:
+        for options in task_options:
+            future = executor.submit(run_task, options)
+            pending[future] = tasks_progress.add_task(
+                f"[red]task: [cyan]{options['source']}",
+                total=None,
+            )
+
+        with Live(layout, console=cons, refresh_per_second=10):
+            while pending:
+                # wake up as soon as any task finishes, the short
+                # timeout only serves picking up new log messages
+                done, _ = concurrent.futures.wait(
+                    pending,
+                    timeout=0.1,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                if log.updated.is_set():
+                    log.updated.clear()
+                    log_text.plain = log.joined
+                for future in done:
+                    task_id = pending.pop(future)
+                    tasks_progress.update(
+                        task_id,
+                        total=1,
+                        completed=1,
+                    )
+                    overall_progress.update(
+                        overall_task_id,
+                        advance=1,
+                    )
+            overall_progress.update(
+                overall_task_id,
+                completed=total_tasks,
+            )
+            log_text.plain = log.joined
 
 
 def main():
@@ -628,11 +813,11 @@ def main():
         command_line += f"{arg}  "  # Assume no space => no quotes
 
     tasks = [task.split() for task in command_line.split(":")]
+    parser = create_parser([global_parser])
     task_options = []
 
     for task in tasks:
-        task_options.append(parse_options([global_parser], task))
-    total_tasks = len(tasks)
+        task_options.append(parse_options(parser, task))
 
     # Determine if we're using a live layout
     live_layout = False
@@ -642,106 +827,25 @@ def main():
                 live_layout = True
                 break
 
-    # Create a shared logger for all child processes
+    # Create a logger shared by all task threads
     create_logger(live_layout)
-    queue = multiprocessing.Manager().Queue(-1)
-    logger_thread = threading.Thread(target=serve_logger_thread, args=(queue,))
-    logger_thread.start()
+    # tasks share the root logger, and its level also decides how btrfs
+    # send / receive are run, so don't let each task set it in turn; use
+    # the most verbose level any task asks for
+    logger.setLevel(
+        min(
+            logging.getLevelName(options["verbosity"].upper())
+            for options in task_options
+        )
+    )
 
     # Make sure we have root privileges
     elevate_privileges()
 
-    if live_layout:
-        layout = Layout(name="root")
-
-        layout.split(
-            Layout(name="header", size=5),
-            Layout(name="main"),
-            Layout(name="footer", size=3),
-        )
-
-        layout["main"].split_row(
-            Layout(name="tasks"), Layout(name="logs", ratio=2, minimum_size=80)
-        )
-
-        layout["header"].update(
-            Panel(
-                Align.center(
-                    Text(
-                        """btrfs-backup-ng\n\nIncremental backups for the btrfs filesystem.""",
-                        justify="center",
-                    ),
-                    vertical="middle",
-                )
-            ),
-        )
-
-        overall_progress = Progress(
-            "[progress.description]{task.description}",
-            BarColumn(),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            SpinnerColumn(),
-            TimeElapsedColumn(),
-        )
-
-        tasks_progress = Progress(
-            "{task.description}",
-            BarColumn(),
-            SpinnerColumn(),
-            TimeElapsedColumn(),
-        )
-
-        overall_task_id = overall_progress.add_task(
-            "[green]All jobs progress:",
-            total=total_tasks,
-        )
-
-        log = RichLogger()
-
-        layout["tasks"].update(Panel(tasks_progress))
-        layout["logs"].update(Panel(Text("\n".join(log.messages))))
-        layout["footer"].update(Panel(overall_progress))
-
-    futures = []  # keep track of the concurrent futures
-    futures_id_map = {}  # associate a task_id with futures
-
     try:
-        with concurrent.futures.ProcessPoolExecutor(
-            max_workers=8
-        ) as executor:  # , thread_name_prefix="Task") as executor:
-            for n in range(len(tasks)):
-                futures.append(executor.submit(run_task, task_options[n], queue))
-                if live_layout:
-                    task_id = tasks_progress.add_task(
-                        f"[red]task: [cyan]{task_options[n]['source']}",
-                        total=None,
-                    )
-                    futures_id_map[futures[n]] = task_id
-
-            if live_layout:
-                with Live(layout, console=cons):
-                    while not overall_progress.finished:
-                        layout["logs"].update(Panel(Text("\n".join(log.messages))))
-                        done, _ = concurrent.futures.wait(futures, timeout=1)
-                        for future in done:
-                            layout["logs"].update(Panel(Text("\n".join(log.messages))))
-                            task_id = futures_id_map[future]
-                            tasks_progress.update(
-                                task_id,
-                                total=1,
-                                completed=1,
-                            )
-                            overall_progress.update(
-                                overall_task_id,
-                                advance=1,
-                            )
-                            futures.remove(future)
-                    overall_progress.update(
-                        overall_task_id,
-                        completed=total_tasks,
-                    )
-                    layout["logs"].update(Panel(Text("\n".join(log.messages))))
-        queue.put_nowait(None)
-        logger_thread.join()
+        if live_layout:
+            do_live_layout(task_options)
+        else:
+            do_logging(task_options)
     except (util.AbortError, KeyboardInterrupt):
         sys.exit(1)
@@ -23,9 +23,7 @@ def choose_endpoint(spec, common_kwargs=None, source=False, excluded_types=()):
     If no endpoint can be determined for the given specification,
     a ``ValueError`` is raised."""
 
-    kwargs = {}
-    if common_kwargs:
-        kwargs.update(common_kwargs)
+    kwargs = dict(common_kwargs or {})
 
     # parse destination string
     if ShellEndpoint not in excluded_types and spec.startswith("shell://"):
@@ -2,6 +2,7 @@
 Common functionality among modules.
 """
 
+import bisect
 import logging
 import os
 import subprocess
@@ -9,6 +10,10 @@ import subprocess
 from ..rich_logger import logger
 from .. import util
 
+# default kernel buffer for the send stream; the kernel's own default of 64 KiB
+# makes 'btrfs send' and 'btrfs receive' block on each other far too often
+PIPE_SIZE = 1 << 20
+
 
 def require_source(method):
     """Decorator that ensures source is set on the object the called method belongs to."""
@@ -33,6 +38,7 @@ class Endpoint:
         btrfs_debug=False,
         source=None,
         fs_checks=True,
+        pipe_size=PIPE_SIZE,
         **kwargs,
     ):
         self.path = path
@@ -45,6 +51,7 @@ class Endpoint:
             self.btrfs_flags += ["-vv"]
         self.source = source
         self.fs_checks = fs_checks
+        self.pipe_size = pipe_size
         self.lock_file_name = ".outstanding_transfers"
         self.__cached_snapshots = None
 
@@ -81,7 +88,10 @@ class Endpoint:
         Popen object."""
 
         cmd = self._build_send_command(snapshot, parent=parent, clones=clones)
-        return self._exec_command(cmd, method="Popen", stdout=subprocess.PIPE)
+        process = self._exec_command(cmd, method="Popen", stdout=subprocess.PIPE)
+        if self.pipe_size > 0:
+            util.set_pipe_size(process.stdout.fileno(), self.pipe_size)
+        return process
 
     def receive(self, stdin):
         """Calls 'btrfs receive', setting the given pipe as its stdin.
@@ -158,16 +168,7 @@ class Endpoint:
                 snapshot.parent_locks.discard(lock_id)
             else:
                 snapshot.locks.discard(lock_id)
-        lock_dict = {}
-        for _snapshot in self.list_snapshots():
-            snap_entry = {}
-            if _snapshot.locks:
-                snap_entry["locks"] = list(_snapshot.locks)
-            if _snapshot.parent_locks:
-                snap_entry["parent_locks"] = list(_snapshot.parent_locks)
-            if snap_entry:
-                lock_dict[_snapshot.get_name()] = snap_entry
-        self._write_locks(lock_dict)
+        self._write_locks(self._build_lock_dict())
         logger.debug(
             "Lock state for %s and lock_id %s changed to %s (parent = %s)",
             snapshot,
@@ -176,6 +177,20 @@ class Endpoint:
             parent,
         )
 
+    @require_source
+    def remove_locks(self, lock_id):
+        """Removes the given lock from the locks and parent locks of all
+        snapshots and calls ``_write_locks`` once, if anything changed."""
+        changed = False
+        for snapshot in self.list_snapshots():
+            if lock_id in snapshot.locks or lock_id in snapshot.parent_locks:
+                snapshot.locks.discard(lock_id)
+                snapshot.parent_locks.discard(lock_id)
+                changed = True
+        if changed:
+            self._write_locks(self._build_lock_dict())
+            logger.debug("All locks for lock_id %s removed", lock_id)
+
     def add_snapshot(self, snapshot, rewrite=True):
         """Adds a snapshot to the cache. If ``rewrite`` is set, a new
         ``util.Snapshot`` object is created with the original ``prefix``
@@ -191,8 +206,8 @@ class Endpoint:
                 self.path, snapshot.prefix, self, time_obj=snapshot.time_obj
             )
 
-        self.__cached_snapshots.append(snapshot)
-        self.__cached_snapshots.sort()
+        # the cache is kept sorted, so insert in place instead of resorting
+        bisect.insort(self.__cached_snapshots, snapshot)
 
         return None
 
@@ -208,10 +223,10 @@ class Endpoint:
 
         logger.info("Removing %d snapshot(s) from %r:", len(to_remove), self)
         for snapshot in snapshots:
-            if snapshot in to_remove:
-                logger.info("  %s", snapshot)
-            else:
+            if snapshot.locks or snapshot.parent_locks:
                 logger.info("  %s - is locked, keeping it", snapshot)
+            else:
+                logger.info("  %s", snapshot)
 
         if to_remove:
             # finally delete them
@@ -221,11 +236,12 @@ class Endpoint:
                 self._exec_command(cmd)
 
             if self.__cached_snapshots is not None:
-                for snapshot in to_remove:
-                    try:
-                        self.__cached_snapshots.remove(snapshot)
-                    except ValueError:
-                        pass
+                removed = {snapshot.get_name() for snapshot in to_remove}
+                self.__cached_snapshots = [
+                    snapshot
+                    for snapshot in self.__cached_snapshots
+                    if snapshot.get_name() not in removed
+                ]
 
     def delete_snapshot(self, snapshot, **kwargs):
         """Delete a snapshot."""
@@ -350,6 +366,20 @@ class Endpoint:
         """Should return all items present at the given ``location``."""
         return os.listdir(location)
 
+    def _build_lock_dict(self):
+        """Builds the lock dict of all snapshots like ``util.read_locks``
+        returns it."""
+        lock_dict = {}
+        for snapshot in self.list_snapshots():
+            snap_entry = {}
+            if snapshot.locks:
+                snap_entry["locks"] = list(snapshot.locks)
+            if snapshot.parent_locks:
+                snap_entry["parent_locks"] = list(snapshot.parent_locks)
+            if snap_entry:
+                lock_dict[snapshot.get_name()] = snap_entry
+        return lock_dict
+
     @require_source
     def _get_lock_file_path(self):
         """Is used by the default ``_read/write_locks`` methods and should
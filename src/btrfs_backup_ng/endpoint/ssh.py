@@ -2,10 +2,14 @@
 Create commands with ssh endpoints.
 """
 
+import atexit
 import copy
+import hashlib
 import os
+import shutil
 import subprocess
 import tempfile
+import threading
 
 from .common import Endpoint
 from ..rich_logger import logger
@@ -15,6 +19,15 @@ from .. import util
 class SSHEndpoint(Endpoint):
     """Commands for creating an ssh endpoint."""
 
+    # directory for the control sockets of multiplexed ssh connections,
+    # shared by all instances so that commands to the same host reuse one
+    # connection instead of doing a new handshake each time
+    __control_dir = None
+    __control_dir_lock = threading.Lock()
+    # 'ssh -O exit' commands for all master connections that may have been
+    # started, they are closed before the control directory is removed
+    __control_exit_cmds = set()
+
     def __init__(
         self,
         hostname,
@@ -135,6 +148,17 @@ class SSHEndpoint(Endpoint):
             new_cmd += ["-p", str(self.port)]
         for opt in self.ssh_opts:
             new_cmd += ["-o", opt]
+        if kwargs.get("method") == "Popen":
+            # long running btrfs send / receive streams get connections of
+            # their own; as channels of a shared master they would all be
+            # encrypted by one process and count against sshd's MaxSessions
+            control_opts = ["ControlMaster=no", "ControlPath=none"]
+        else:
+            control_opts = self._build_control_opts()
+        # ssh uses the first value given for an option, so these don't
+        # override any ControlMaster settings from --ssh-opt
+        for opt in control_opts:
+            new_cmd += ["-o", opt]
         new_cmd += [self._build_connect_string()]
         if self.ssh_sudo:
             new_cmd += ["sudo"]
@@ -166,6 +190,56 @@ class SSHEndpoint(Endpoint):
             s = f"{s}:{self.port}"
         return s
 
+    def _build_control_opts(self):
+        """Returns ssh_config options for multiplexing short ssh commands
+        to a host over one master connection, see ssh_config(5)."""
+        cls = SSHEndpoint
+        with cls.__control_dir_lock:
+            if cls.__control_dir is None:
+                cls.__control_dir = tempfile.mkdtemp(prefix="btrfs-backup-ng-ssh-")
+                logger.debug("Created ssh control directory: %s", cls.__control_dir)
+                atexit.register(cls._close_control_masters)
+        # %C only covers user, host and port; endpoints with different ssh
+        # options (identity, proxy, ...) must not share a master connection
+        opts_hash = hashlib.sha1("\0".join(self.ssh_opts).encode()).hexdigest()
+        control_path = os.path.join(cls.__control_dir, "%C-" + opts_hash[:12])
+
+        exit_cmd = ["ssh"]
+        if self.port:
+            exit_cmd += ["-p", str(self.port)]
+        for opt in self.ssh_opts:
+            exit_cmd += ["-o", opt]
+        exit_cmd += ["-o", f"ControlPath={control_path}", "-O", "exit"]
+        exit_cmd += [self._build_connect_string()]
+        with cls.__control_dir_lock:
+            cls.__control_exit_cmds.add(tuple(exit_cmd))
+
+        return [
+            "ControlMaster=auto",
+            f"ControlPath={control_path}",
+            "ControlPersist=60",
+        ]
+
+    @staticmethod
+    def _close_control_masters():
+        """Stops all master connections and removes the control directory.
+        Registered to run at exit, persisting masters would otherwise keep
+        running (and holding our stderr) for a while after we're done."""
+        cls = SSHEndpoint
+        for exit_cmd in cls.__control_exit_cmds:
+            try:
+                # fails harmlessly if no master was started for this command
+                subprocess.call(
+                    exit_cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=10,
+                )
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        shutil.rmtree(cls.__control_dir, ignore_errors=True)
+
     def _path_to_sshfs(self, path):
         """Joins the given ``path`` with the sshfs mount_point."""
         if not self.sshfs:
@@ -16,55 +16,6 @@ rich_handler = RichHandler()
 logger = logging.getLogger()
 
 
-# class Borg:
-#     """Basic Borg pattern class."""
-
-#     __monostate = {}
-
-#     def __init__(self):
-#         """Initialize the shared internal state."""
-#         self.__dict__ = self.__monostate
-
-
-# class RichLogger(Borg):
-#     """A Borg subclass to share internal state of the rich logger."""
-
-#     def __init__(self):
-#         """Initialize the Borg and the logger."""
-#         Borg.__init__(self)
-#         self.messages = deque(["btrfs-backup-ng -- logger"], maxlen=20)
-
-#     def write(self, message):
-#         """Write log message"""
-#         self.messages.extend(message.splitlines())
-
-#     def flush(self):
-#         """Place holder"""
-#         pass
-
-
-# class RichLogger:
-#     """Borg pattern class to share internal state of the rich logger."""
-
-#     __monostate = None
-
-#     def __init__(self):
-#         """Initialize the logger state."""
-#         if RichLogger.__monostate is None:
-#             RichLogger.__monostate = self.__dict__
-#             self.messages = deque(["btrfs-backup-ng -- logger"], maxlen=20)
-#         else:
-#             self.__dict__ = RichLogger.__monostate
-
-#     def write(self, message):
-#         """Add log message"""
-#         self.messages.extend(message.splitlines())
-
-#     def flush(self):
-#         """Place holder."""
-#         pass
-
-
 class RichLogger:
     """A singleton pattern class to share internal state of the rich logger."""
 
@@ -74,6 +25,9 @@ class RichLogger:
     def __init__(self):
         """Init"""
         self.messages = deque(["btrfs-backup-ng -- logger"], maxlen=20)
+        self.updated = threading.Event()
+        self.__generation = 0
+        self.__joined = (-1, "")
 
     def __new__(cls, *args, **kwargs):
         """Singleton"""
@@ -83,9 +37,20 @@ class RichLogger:
                     cls.__instance = super().__new__(cls, *args, **kwargs)
         return cls.__instance
 
+    @property
+    def joined(self):
+        """All buffered messages as a single string, joined only when
+        messages were written since the last call."""
+        generation = self.__generation
+        if self.__joined[0] != generation:
+            self.__joined = (generation, "\n".join(self.messages))
+        return self.__joined[1]
+
     def write(self, message):
         """Write log message"""
         self.messages.extend(message.splitlines())
+        self.__generation += 1
+        self.updated.set()
 
     def flush(self):
         """Place holder"""
@@ -104,7 +69,7 @@ def create_logger(live_layout):
         cons = Console()
         rich_handler = RichHandler(console=cons, show_path=False)
     logging.basicConfig(
-        format="(%(processName)s) %(message)s",
+        format="(%(threadName)s) %(message)s",
         datefmt="%H:%M:%S",
         level=logging.INFO,
         handlers=[rich_handler],
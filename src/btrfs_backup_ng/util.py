@@ -3,9 +3,12 @@ Common utility code shared between modules.
 """
 
 import argparse
+import datetime
+import fcntl
 import functools
 import json
 import os
+import re
 import subprocess
 import sys
 import time
@@ -14,7 +17,15 @@ from .rich_logger import logger
 
 
 DATE_FORMAT = "%Y%m%d-%H%M%S"
+# matches strings in DATE_FORMAT, used to avoid the slow time.strptime()
+DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})", re.ASCII)
 MOUNTS_FILE = "/proc/mounts"
+PIPE_MAX_SIZE_FILE = "/proc/sys/fs/pipe-max-size"
+# not exported by the fcntl module before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+# fcntl() takes the size as a C int, larger values would be truncated
+PIPE_SIZE_MAX = 2**31 - 1
 
 
 class AbortError(Exception):
@@ -38,6 +49,8 @@ class Snapshot:
         self.time_obj = time_obj
         self.locks = set()
         self.parent_locks = set()
+        self.__name = None
+        self.__path = None
 
     def __eq__(self, other):
         return self.prefix == other.prefix and self.time_obj == other.time_obj
@@ -54,11 +67,18 @@ class Snapshot:
 
     def get_name(self):
         """Return a snapshot's name."""
-        return self.prefix + date_to_str(self.time_obj)
+        # names are needed for logging, paths and locks alike, but neither
+        # prefix nor time_obj change, so run strftime only once
+        if self.__name is None:
+            self.__name = self.prefix + date_to_str(self.time_obj)
+        return self.__name
 
     def get_path(self):
         """Return full path to a snapshot."""
-        return os.path.join(self.location, self.get_name())
+        # used for send, receive and deletion commands of the same snapshot
+        if self.__path is None:
+            self.__path = os.path.join(self.location, self.get_name())
+        return self.__path
 
     def find_parent(self, present_snapshots):
         """Returns object from ``present_snapshot`` most suitable for being
@@ -91,6 +111,33 @@ def exec_subprocess(command, method="check_output", **kwargs):
         raise AbortError() from e
 
 
+@functools.lru_cache(maxsize=None)
+def get_hostname():
+    """Return the name of this host, which doesn't change while we run."""
+    return os.uname()[1]
+
+
+def set_pipe_size(fd, size):
+    """Tries to enlarge the kernel buffer of the pipe ``fd`` to ``size``
+    bytes and returns the size actually in effect, or ``None`` if it
+    can't be changed (e.g. not on Linux or not a pipe)."""
+    size = min(size, PIPE_SIZE_MAX)
+    try:
+        try:
+            fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        except PermissionError:
+            # unprivileged users are capped at pipe-max-size
+            with open(PIPE_MAX_SIZE_FILE, encoding="utf-8") as f:
+                fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, int(f.read())))
+        result = fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except (OSError, ValueError) as e:
+        # only a tuning, the transfer works with any pipe size
+        logger.debug("Couldn't set pipe size of fd %d: %s", fd, e)
+        return None
+    logger.debug("Pipe size of fd %d is %d bytes", fd, result)
+    return result
+
+
 def log_heading(caption):
     """Formatted heading for logging output sections."""
     return f"{f'--[ {caption} ]':-<50}"
@@ -113,6 +160,14 @@ def str_to_date(time_string=None, fmt=None):
         time_string = date_to_str()
     if fmt is None:
         fmt = DATE_FORMAT
+    if fmt == DATE_FORMAT:
+        match = DATE_RE.fullmatch(time_string)
+        if match:
+            try:
+                return datetime.datetime(*map(int, match.groups())).timetuple()
+            except ValueError:
+                # e.g. leap seconds, leave the verdict to strptime
+                pass
     return time.strptime(time_string, fmt)
 
 
@@ -153,12 +208,14 @@ def is_btrfs(path):
 
 def is_subvolume(path):
     """Checks whether the given path is a btrfs subvolume."""
-    if not is_btrfs(path):
-        return False
     logger.debug("Checking for btrfs subvolume: %s", path)
-    # subvolumes always have inode 256
+    # subvolumes always have inode 256; a single stat is much cheaper than
+    # scanning the mounts file, so rule out other paths with it first
     st = os.stat(path)
-    result = st.st_ino == 256
+    if st.st_ino != 256:
+        logger.debug("  -> Inode is %d, result is False", st.st_ino)
+        return False
+    result = is_btrfs(path)
     logger.debug("  -> Inode is %d, result is %r", st.st_ino, result)
     return result
 
@@ -199,6 +256,19 @@ def write_locks(lock_dict):
 # argparse related classes
 
 
+def pipe_size(value):
+    """argparse type for pipe buffer sizes in bytes."""
+    try:
+        size = int(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}") from e
+    if not 0 <= size <= PIPE_SIZE_MAX:
+        raise argparse.ArgumentTypeError(
+            f"size must be between 0 and {PIPE_SIZE_MAX}, got {size}"
+        )
+    return size
+
+
 class MyArgumentParser(argparse.ArgumentParser):
     """Custom parser that allows for comments in argument files."""
 